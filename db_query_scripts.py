@@ -1,7 +1,11 @@
 import time
+import json
+import argparse
+import base64
 import datetime
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+from query_instrumentation import QueryStats, InstrumentedCursor
 
 
 class ConnectionError(Exception):
@@ -11,15 +15,18 @@ class ConnectionError(Exception):
         super().__init__(self.message)
 
 
+# Connection settings for the MySQL server, shared by single connections and connection pools
+DB_CONFIG = {'user': 'testuser',
+             'password': 'testuser',
+             'database': 'tooldb',
+             'host': '127.0.0.1',
+             'allow_local_infile': True}
+
+
 def sql_connection():
     # This function actually makes the connection to the MySQL server
     try:  # Try to make the connection
-        connection = mysql.connector.connect(
-            user='testuser',
-            password='testuser',
-            database='tooldb',
-            host='127.0.0.1',
-            allow_local_infile=True)
+        connection = mysql.connector.connect(**DB_CONFIG)
 
         if connection.is_connected():  # If the connection is active and healthy
             return connection  # Return the connection object
@@ -29,7 +36,137 @@ def sql_connection():
     return None  # And return nothing
 
 
-connection = sql_connection()
+def sql_connection_pool(pool_size=5, pool_name='toolsales'):
+    # Makes a pool of connections to the MySQL server that ToolSalesData objects can check connections out of
+    try:
+        return pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size, **DB_CONFIG)
+
+    except Error as err_msg:  # If the pool can't be set up
+        print(f'ERROR: {err_msg}')
+    return None
+
+
+# Every query the client runs is timed and recorded here - queries over the threshold (in seconds) also get EXPLAINed
+SLOW_QUERY_THRESHOLD = 0.5
+query_stats = QueryStats(slow_query_threshold=SLOW_QUERY_THRESHOLD)
+
+
+def check_date_range(start_date, end_date):
+    # A date range needs both ends - a lone start or end date would otherwise be silently ignored
+    if (start_date is None) != (end_date is None):
+        raise ValueError('ERROR: give both a start date and an end date, or neither.')
+
+
+class ToolSalesData:
+    # Data access layer for every query the client issues
+    # Each statement is prepared on the server once, on its own cursor, the first time it is used. Later calls only
+    # send the parameter values over the binary protocol, so the server doesn't re-parse the SQL on every lookup.
+    # The object holds one connection checked out of a pool until close(), so its prepared statements are reused by
+    # every call made through it. close() deallocates them and returns the connection, which the pool resets, so
+    # statements are not carried over to the next checkout - keep one long-lived object per worker to get the reuse.
+    SALES_COLUMNS = "SELECT sale_id, c_id, sale_date, quantity, c_price FROM sales WHERE t_id = %s AND r_id = %s "
+    SALES_SUM = ("SELECT T.t_name_full, SUM((S.quantity * S.c_price)) "
+                 "FROM tools T, sales S "
+                 "WHERE T.t_id = S.t_id AND S.t_id = %s AND S.r_id = %s ")
+    SALES_RANGE = "AND sale_date BETWEEN %s AND %s "
+    SALES_SEEK = "AND (sale_date > %s OR (sale_date = %s AND sale_id > %s)) "  # Keyset pagination on (date, id)
+    SALES_ORDER = "ORDER BY sale_date, sale_id LIMIT %s"
+
+    STATEMENTS = {
+        'retailer_name': "SELECT r_name FROM retailers WHERE r_id = %s",
+        'manufacturers': "SELECT m_name, m_id FROM manufacturers ORDER BY m_id ASC",
+        'manufacturer_name': "SELECT m_name FROM manufacturers WHERE m_id = %s",
+        'tools_by_manufacturer': "SELECT t_id, t_name_full FROM tools WHERE m_id = %s ORDER BY t_name_full ASC",
+        'tool_name': "SELECT t_name_full FROM tools WHERE t_id = %s",
+        'sales_page': SALES_COLUMNS + SALES_ORDER,
+        'sales_page_seek': SALES_COLUMNS + SALES_SEEK + SALES_ORDER,
+        'sales_range_page': SALES_COLUMNS + SALES_RANGE + SALES_ORDER,
+        'sales_range_page_seek': SALES_COLUMNS + SALES_RANGE + SALES_SEEK + SALES_ORDER,
+        'sales_sum': SALES_SUM + "GROUP BY T.t_name_full",
+        'sales_range_sum': SALES_SUM + "AND sale_date BETWEEN %s AND %s GROUP BY T.t_name_full",
+    }
+
+    def __init__(self, pool, stats=query_stats):
+        if pool is None:
+            raise ConnectionError
+
+        try:
+            self.connection = pool.get_connection()  # Held until close() is called
+        except Error as err_msg:  # e.g. the pool is exhausted or the server is down
+            raise ConnectionError(f'ERROR: {err_msg}')
+
+        self.stats = stats
+        self.cursors = {}  # One prepared-statement cursor per statement name
+
+    def is_connected(self):
+        return self.connection is not None and self.connection.is_connected()
+
+    def run(self, name, params=()):
+        # Execute a named statement, preparing it on first use, and return all of its rows
+        if name not in self.cursors:
+            self.cursors[name] = InstrumentedCursor(self.connection, self.stats, prepared=True)
+
+        cursor = self.cursors[name]
+        cursor.execute(self.STATEMENTS[name], params)  # The same statement object is re-executed, not re-prepared
+        return cursor.fetchall()
+
+    def run_one(self, name, params=()):
+        # Execute a named statement and return its first row, or None if there wasn't one
+        rows = self.run(name, params)
+        return rows[0] if rows else None
+
+    def retailer_name(self, r_id):
+        record = self.run_one('retailer_name', (r_id,))
+        return record[0] if record else None
+
+    def manufacturers(self):
+        return self.run('manufacturers')
+
+    def manufacturer_name(self, m_id):
+        record = self.run_one('manufacturer_name', (m_id,))
+        return record[0] if record else None
+
+    def tools_by_manufacturer(self, m_id):
+        return self.run('tools_by_manufacturer', (m_id,))
+
+    def tool_name(self, t_id):
+        record = self.run_one('tool_name', (t_id,))
+        return record[0] if record else None
+
+    def sales_page(self, t_id, r_id, limit, start_date=None, end_date=None, after=None):
+        # One page of sale records, optionally limited to a date range and seeking past an (sale_date, sale_id) key
+        check_date_range(start_date, end_date)
+        name = 'sales_page'
+        params = [t_id, r_id]
+
+        if start_date is not None and end_date is not None:
+            name = 'sales_range_page'
+            params += [start_date, end_date]
+
+        if after is not None:
+            name += '_seek'
+            last_date, last_id = after
+            params += [last_date, last_date, last_id]
+
+        params.append(limit)
+        return self.run(name, tuple(params))
+
+    def sales_sum(self, t_id, r_id, start_date=None, end_date=None):
+        # Tool name and total sale value for a tool and retailer, optionally limited to a date range
+        check_date_range(start_date, end_date)
+        if start_date is not None and end_date is not None:
+            return self.run_one('sales_range_sum', (t_id, r_id, start_date, end_date))
+        return self.run_one('sales_sum', (t_id, r_id))
+
+    def close(self):
+        # Deallocate the prepared statements and hand the connection back to the pool
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors = {}
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
 
 def connection_check(connection):
@@ -40,9 +177,9 @@ def connection_check(connection):
         return False
 
 
-def tool_selection(connection):
+def tool_selection(data):
     # First check if the connection to MySQL is still active and healthy
-    if not connection_check(connection):
+    if not connection_check(data):
         raise ConnectionError
 
     else:
@@ -60,13 +197,7 @@ def tool_selection(connection):
             except ValueError:  # If integer cast is not successful
                 print("Invalid input. Please enter a valid integer between 1 and 10.")  # Error message and restart
 
-    myc = connection.cursor()  # Activate MySQL cursor
-
-    fetch_r_name = "SELECT r_name FROM retailers WHERE r_id = %s"  # Store the query results
-    myc.execute(fetch_r_name, (r_id,))  # Run the query separately - best practices to prevent SQL injection
-
-    retailer_name_record = myc.fetchone()
-    retailer_name = retailer_name_record[0]  # Store 'clean' retailer name
+    retailer_name = data.retailer_name(r_id)  # Prepared statement - the ID is never spliced into the SQL
 
     print(f'Welcome, representative from {retailer_name}.')  # We did all that for a fancy welcome message.
     print('This form allows you to check sales and associated customer records for a specified tool.')
@@ -75,9 +206,7 @@ def tool_selection(connection):
     print('Here is a list of all tool manufacturers in the database and their associated manufacturer ID numbers:')
     time.sleep(1.5)
 
-    myc.execute("SELECT m_name, m_id FROM manufacturers ORDER BY m_id ASC")
-
-    for record in myc:
+    for record in data.manufacturers():
         print(f'Manufacturer: {record[0]} || Manufacturer ID: {record[1]}')  # Cleaning up the output
         time.sleep(0.25)  # Some space between line prints
 
@@ -95,20 +224,15 @@ def tool_selection(connection):
             print("Invalid input. Please enter a valid integer between 1 and 20.")  # Error message and restart
 
     # Similar process here - fetching manufacturer name, resisting injection, storing name
-    fetch_m_name = "SELECT m_name FROM manufacturers WHERE m_id = %s"
-    myc.execute(fetch_m_name, (m_id,))
-
-    manufacturer_name_record = myc.fetchone()
-    manufacturer_name = manufacturer_name_record[0]
+    manufacturer_name = data.manufacturer_name(m_id)
 
     # Printing the tool list for the selected manufacturer
     print(f'{manufacturer_name} manufactures the following tools:')
     time.sleep(1)
 
-    myc.execute(f"SELECT t_id, t_name_full FROM tools WHERE m_id = {m_id} ORDER BY t_name_full ASC")
     valid_t_ids = []  # Instantiate an empty list to store the valid t_ids
 
-    for record in myc:
+    for record in data.tools_by_manufacturer(m_id):
         print(f'Tool ID: {record[0]} Tool Name: {record[1]}')
         valid_t_ids.append(record[0])  # This makes sure input can be limited later on
         time.sleep(0.25)
@@ -132,19 +256,127 @@ def tool_selection(connection):
 #t_id, r_id = tool_selection(connection)  # Now store the returned values in the global scope
 
 
-def fetch_sales(connection, t_id, r_id):  # Function to fetch the sale records
-    if not connection_check(connection):  # Check connection
+# Number of sale records returned per page in record mode
+SALES_PAGE_SIZE = 50
+
+# Index that the keyset pagination in fetch_sales_page seeks on
+# The same statement is written to create_sales_index.sql by simulating_db_data.py alongside the load_*.sql files,
+# and can be applied to an existing database with: python db_query_scripts.py --create-index
+SALES_PAGE_INDEX = 'idx_sales_tool_retailer_date'
+
+
+def sales_index_exists(connection):
+    # Checks whether the pagination index is present on the sales table
+    myc = connection.cursor()
+    myc.execute("SELECT COUNT(*) FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = 'sales' AND index_name = %s", (SALES_PAGE_INDEX,))
+    exists = myc.fetchone()[0] > 0
+    myc.close()
+    return exists
+
+
+def create_sales_index(connection):
+    # Creates the (t_id, r_id, sale_date, sale_id) index on sales if it isn't there yet - safe to run repeatedly
+    # Returns True if the index had to be created
+    if sales_index_exists(connection):  # MySQL has no CREATE INDEX IF NOT EXISTS, hence the check
+        return False
+
+    myc = connection.cursor()
+    myc.execute(f"CREATE INDEX {SALES_PAGE_INDEX} ON sales (t_id, r_id, sale_date, sale_id)")
+    myc.close()
+    return True
+
+
+def token_date(value):
+    # Dates in page tokens are kept as YYYY-MM-DD strings, whether they were given as strings or datetime.date objects
+    return str(value) if value is not None else None
+
+
+def encode_page_token(t_id, r_id, start_date, end_date, sale_date, sale_id):
+    # The continuation token is the (sale_date, sale_id) key of the last row served, plus the listing it belongs to
+    payload = {'t_id': t_id, 'r_id': r_id, 'start_date': token_date(start_date), 'end_date': token_date(end_date),
+               'sale_date': sale_date.strftime('%Y-%m-%d'), 'sale_id': sale_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token, t_id, r_id, start_date=None, end_date=None):
+    # Unpack a continuation token, making sure it was issued for the same tool, retailer and date range
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        sale_date = datetime.datetime.strptime(payload['sale_date'], '%Y-%m-%d').date()
+        sale_id = int(payload['sale_id'])
+        token_t_id, token_r_id = payload['t_id'], payload['r_id']
+        token_start_date, token_end_date = payload['start_date'], payload['end_date']
+
+    except (ValueError, KeyError, TypeError):  # Covers bad base64, bad JSON and missing or malformed fields
+        raise ValueError('ERROR: invalid page token.')
+
+    if (token_t_id, token_r_id) != (t_id, r_id):
+        raise ValueError('ERROR: page token does not belong to this tool and retailer.')
+
+    if (token_start_date, token_end_date) != (token_date(start_date), token_date(end_date)):
+        raise ValueError('ERROR: page token does not belong to this date range.')
+
+    return sale_date, sale_id
+
+
+def fetch_sales_page(data, t_id, r_id, start_date=None, end_date=None, page_token=None,
+                     page_size=SALES_PAGE_SIZE):
+    # Fetch one page of sale records ordered by (sale_date, sale_id), returning the rows and the next page's token
+    # Rather than an OFFSET, each page seeks past the last key served, so page N costs the same as page 1
+    # That only holds once the SALES_PAGE_INDEX index exists - without it every page filters and sorts all the sales
+    # for the tool and retailer (see create_sales_index)
+    if page_size < 1:
+        raise ValueError('ERROR: page size must be at least 1.')
+    check_date_range(start_date, end_date)
+
+    if not connection_check(data):
         raise ConnectionError
 
-    else:
-        myc = connection.cursor()  # Get the cursor
+    after = None
+    if page_token is not None:  # Seek past the last record of the previous page
+        after = decode_page_token(page_token, t_id, r_id, start_date, end_date)
+
+    # Fetch one extra row to find out whether another page exists
+    records = data.sales_page(t_id, r_id, page_size + 1, start_date, end_date, after)
+
+    if len(records) <= page_size:  # This is the last page
+        return records, None
 
+    records = records[:page_size]
+    last_record = records[-1]
+    return records, encode_page_token(t_id, r_id, start_date, end_date, last_record[2], last_record[0])
+
+
+def print_sales_pages(data, t_id, r_id, start_date=None, end_date=None):
+    # Print sale records one page at a time, asking before fetching each following page
+    page_token = None
+
+    while True:
+        records, page_token = fetch_sales_page(data, t_id, r_id, start_date, end_date, page_token)
+
+        for record in records:
+            clean_date = record[2].strftime('%Y-%m-%d')  # Convert datetime.date to string
+            clean_price = float(record[4])  # Convert Decimal to float
+            print(f'Sale ID: {record[0]}, Customer ID: {record[1]}, Sale Date: {clean_date}, '
+                  f'Quantity: {record[3]}, Customer Price: {clean_price}')
+
+        if page_token is None:  # No more records to show
+            break
+
+        if input('Enter n for the next page of records, or anything else to stop: ') != 'n':
+            break
+
+
+def fetch_sales(data, t_id, r_id):  # Function to fetch the sale records
+    if not connection_check(data):  # Check connection
+        raise ConnectionError
+
+    else:
         print(f'You have selected tool ID {t_id}.')
         time.sleep(1)
 
-        myc.execute(f"SELECT t_name_full FROM tools WHERE t_id = {t_id}")  # Fetching tool name
-        tool_name_record = myc.fetchone()
-        tool_name = tool_name_record[0]  # Storing tool name
+        tool_name = data.tool_name(t_id)  # Fetching and storing tool name
 
         print(f'Locating sales records for {tool_name}...')
         time.sleep(1)
@@ -215,40 +447,22 @@ def fetch_sales(connection, t_id, r_id):  # Function to fetch the sale records
             print(f'The full list of sale records for {tool_name} is as follows:')
             time.sleep(1)
 
-            myc.execute("SELECT sale_id, c_id, sale_date, quantity, c_price "
-                        "FROM sales WHERE t_id = %s AND r_id = %s ORDER BY sale_date", (t_id, r_id))  # Resist injection
-
-            for record in myc:
-                clean_date = record[2].strftime('%Y-%m-%d')  # Convert datetime.date to string
-                clean_price = float(record[4])  # Convert Decimal to float
-                print(f'Sale ID: {record[0]}, Customer ID: {record[1]}, Sale Date: {clean_date}, '
-                      f'Quantity: {record[3]}, Customer Price: {clean_price}')
+            print_sales_pages(data, t_id, r_id)  # Walk the records a page at a time
 
         # For sale records with a date range
         elif method == 'r' and date_choice == 'y':
             print(f'The full list of sale records for {tool_name} is as follows:')
             time.sleep(1)
 
-            myc.execute("SELECT sale_id, c_id, sale_date, quantity, c_price "
-                        "FROM sales WHERE t_id = %s AND r_id = %s "
-                        "AND sale_date BETWEEN %s AND %s ORDER BY sale_date", (t_id, r_id, start_date, end_date))
-
-            for record in myc:
-                clean_date = record[2].strftime('%Y-%m-%d')  # Convert datetime.date to string
-                clean_price = float(record[4])  # Convert Decimal to float
-                print(f'Sale ID: {record[0]}, Customer ID: {record[1]}, Sale Date: {clean_date}, '
-                      f'Quantity: {record[3]}, Customer Price: {clean_price}')
+            print_sales_pages(data, t_id, r_id, start_date, end_date)
 
         # For a sum of sale value with no date range
         elif method == 's' and date_choice == 'n':
             print(f'The total value of sales for {tool_name} is:')
 
-            myc.execute("SELECT T.t_name_full, SUM((S.quantity * S.c_price)) "
-                        "FROM tools T, sales S "
-                        "WHERE T.t_id = S.t_id AND S.t_id = %s AND S.r_id = %s "
-                        "GROUP BY T.t_name_full", (t_id, r_id))
+            record = data.sales_sum(t_id, r_id)  # There's only going to be one record
 
-            for record in myc:  # There's only going to be one record
+            if record is not None:
                 clean_price = float(record[1])  # Convert Decimal to float
                 print(f'Tool: {record[0]} || Sum of sales: {clean_price}')
 
@@ -256,13 +470,9 @@ def fetch_sales(connection, t_id, r_id):  # Function to fetch the sale records
         elif method == 's' and date_choice == 'y':
             print(f'The total value of sales for {tool_name} is:')
 
-            myc.execute("SELECT T.t_name_full, SUM((S.quantity * S.c_price)) "
-                        "FROM tools T, sales S "
-                        "WHERE T.t_id = S.t_id AND S.t_id = %s AND S.r_id = %s "
-                        "AND sale_date BETWEEN %s AND %s "
-                        "GROUP BY T.t_name_full", (t_id, r_id, start_date, end_date))
+            record = data.sales_sum(t_id, r_id, start_date, end_date)  # There's only going to be one record
 
-            for record in myc:  # There's only going to be one record
+            if record is not None:
                 clean_price = float(record[1])  # Convert Decimal to float
                 print(f'Tool: {record[0]} || Sum of sales: {clean_price}')
 
@@ -274,11 +484,42 @@ def fetch_sales(connection, t_id, r_id):  # Function to fetch the sale records
 #connection.close()  # Close the MySQL connection
 
 # And finally, ensure the script can be run directly from the CLI
+def parse_args():
+    parser = argparse.ArgumentParser(description='Look up sale records for a tool in the ToolSales database.')
+    parser.add_argument('--stats-file', default='query_stats.json',
+                        help='File to save query statistics to - use a .prom extension for Prometheus text format')
+    parser.add_argument('--create-index', action='store_true',
+                        help='Create the sales pagination index if it is missing, then exit')
+    return parser.parse_args()
+
+
 def main():
-    connection = sql_connection()
-    t_id, r_id = tool_selection(connection)
-    fetch_sales(connection, t_id, r_id)
-    connection.close()
+    args = parse_args()
+
+    if args.create_index:  # One-off schema step rather than an interactive session
+        connection = sql_connection()
+        if connection is None:
+            raise ConnectionError
+
+        if create_sales_index(connection):
+            print(f'Created index {SALES_PAGE_INDEX} on sales.')
+        else:
+            print(f'Index {SALES_PAGE_INDEX} already exists on sales.')
+        connection.close()
+        return
+
+    data = None
+    try:
+        data = ToolSalesData(sql_connection_pool(pool_size=1))
+        t_id, r_id = tool_selection(data)
+        fetch_sales(data, t_id, r_id)
+
+    finally:  # Even after an error or Ctrl-C, release the connection and keep the stats gathered so far
+        try:
+            if data is not None:
+                data.close()
+        finally:
+            query_stats.save(args.stats_file)
 
 
 if __name__ == '__main__':
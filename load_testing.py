@@ -0,0 +1,252 @@
+"""
+This script is a load test for the retailer query workload. It replays simulated retailer sessions - the same lookups
+tool_selection and fetch_sales make, followed by either a paged list of sale records or a total sum of sales, with or
+without a date range - from several concurrent workers against a local copy of the database.
+
+Tools and retailers are drawn from the dataframes built by simulating_db_data.py, and for each scale factor the sales
+table is re-seeded with that multiple of the usual 1,000,000 simulated sales. Throughput and latency percentiles are
+then reported for every combination of scale factor and worker count, so the effect of a schema or index change can be
+checked before it reaches production.
+
+By default the schema is measured as it stands. Passing --create-index adds the sales pagination index before the run,
+so running once without and once with it gives a before/after comparison. Every result records whether the index was
+present.
+
+NOTE: seeding replaces the contents of the sales table, so only point this at a local test database. Listing 1.0 as the
+last scale factor leaves the table at its usual size once the run is finished.
+"""
+
+import json
+import time
+import random
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from db_query_scripts import (ConnectionError, ToolSalesData, SLOW_QUERY_THRESHOLD, sql_connection,
+                              sql_connection_pool, fetch_sales_page, create_sales_index,
+                              sales_index_exists)
+from query_instrumentation import QueryStats, percentile
+from simulating_db_data import (construct_initial_dataframes, construct_orders_dataframe, construct_stock_dataframe,
+                                construct_inventory_dataframe, construct_sales_dataframe)
+
+
+BASE_NUM_SALES = 1000000  # The number of sales simulating_db_data.py generates, i.e. a scale factor of 1.0
+INSERT_BATCH_SIZE = 10000  # Rows per INSERT when seeding the sales table
+MAX_POOL_SIZE = 32  # The MySQL connector won't build a connection pool larger than this
+
+
+def construct_workload_dataframes():
+    # Build the dataframes the workload draws from, skipping the ones (e.g. customers) the queries never touch
+    manufacturers, tools, retailers = construct_initial_dataframes()
+    orders = construct_orders_dataframe(tools)
+    stock = construct_stock_dataframe(retailers, tools)
+    inventory = construct_inventory_dataframe(stock, orders)
+
+    return tools, retailers, inventory
+
+
+def seed_sales(inventory, retailers, num_sales, create_index=False):
+    # Replace the contents of the sales table with a freshly simulated set of num_sales sales
+    # The pagination index is only added when create_index is set, otherwise the schema is left as it is
+    connection = sql_connection()
+    if connection is None:
+        raise ConnectionError
+
+    myc = connection.cursor()
+
+    # The customers table stays as simulating_db_data.py loaded it, so new sales are made by existing customers only
+    myc.execute("SELECT c_id FROM customers")
+    customer_ids = [record[0] for record in myc.fetchall()]
+    if not customer_ids:
+        raise ValueError('ERROR: the customers table is empty - load the simulated data before running load tests.')
+
+    sales = construct_sales_dataframe(inventory, retailers, num_sales, customer_ids)
+
+    # The connector can't bind NumPy and Pandas types, so convert each row to plain Python values
+    rows = [(int(sale.sale_id), int(sale.r_id), int(sale.c_id), sale.sale_date.date(), int(sale.t_id),
+             int(sale.quantity), float(sale.c_price)) for sale in sales.itertuples(index=False)]
+
+    myc.execute("TRUNCATE TABLE sales")  # Much faster than deleting the old sales row by row
+
+    insert_sale = ("INSERT INTO sales (sale_id, r_id, c_id, sale_date, t_id, quantity, c_price) "
+                   "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        myc.executemany(insert_sale, rows[start:start + INSERT_BATCH_SIZE])
+    connection.commit()
+
+    if create_index and create_sales_index(connection):
+        print('Created the sales pagination index.')
+    index_present = sales_index_exists(connection)
+
+    myc.execute("ANALYZE TABLE sales")  # Refresh index statistics so the optimizer sees the new table size
+    myc.fetchall()
+
+    myc.close()
+    connection.close()
+
+    # Return the date span of the new sales, so that date ranges in the workload fall inside it, and the index state
+    return (sales['sale_date'].min().date(), sales['sale_date'].max().date()), index_present
+
+
+def retailer_session(data, rng, workload):
+    # Replay one simulated retailer visit and return a label for the kind of sales lookup it made
+    r_id = rng.choice(workload['r_ids'])
+    t_id, m_id = rng.choice(workload['tools'])
+
+    # The lookups tool_selection makes while the retailer picks a tool
+    data.retailer_name(r_id)
+    data.manufacturers()
+    data.manufacturer_name(m_id)
+    data.tools_by_manufacturer(m_id)
+    data.tool_name(t_id)
+
+    start_date, end_date = None, None
+    if rng.random() < workload['range_share']:  # Pick a random date range inside the seeded sales period
+        first_date, last_date = workload['date_bounds']
+        span = (last_date - first_date).days
+        start = first_date + datetime.timedelta(days=rng.randint(0, span))
+        start_date = start.strftime('%Y-%m-%d')
+        end_date = min(start + datetime.timedelta(days=rng.randint(7, 365)), last_date).strftime('%Y-%m-%d')
+
+    range_label = 'range' if start_date is not None else 'all'
+
+    if rng.random() < workload['record_share']:  # Record mode - walk a few pages of sale records
+        page_token = None
+        for _ in range(rng.randint(1, workload['max_pages'])):
+            _, page_token = fetch_sales_page(data, t_id, r_id, start_date, end_date, page_token)
+            if page_token is None:
+                break
+        return f'record/{range_label}'
+
+    data.sales_sum(t_id, r_id, start_date, end_date)  # Sum mode
+    return f'sum/{range_label}'
+
+
+def run_worker(pool, stats, workload, seed, deadline):
+    # Run retailer sessions back to back until the deadline, timing each one
+    rng = random.Random(seed)
+    data = ToolSalesData(pool, stats)  # Each worker holds its own connection and prepared statements
+    timings = []
+
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            label = retailer_session(data, rng, workload)
+            timings.append((label, time.perf_counter() - start))
+    finally:
+        data.close()
+
+    return timings
+
+
+def summarize_latencies(latencies):
+    # Latency percentiles in milliseconds
+    return {'count': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+            'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None}
+
+
+def run_load(pool, workload, num_workers, duration, seed):
+    # Run num_workers concurrent workers for duration seconds and summarize throughput and latency
+    stats = QueryStats(slow_query_threshold=SLOW_QUERY_THRESHOLD)
+
+    start = time.perf_counter()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(run_worker, pool, stats, workload, seed + worker, deadline)
+                   for worker in range(num_workers)]
+        timings = [timing for future in futures for timing in future.result()]
+    elapsed = time.perf_counter() - start
+
+    query_summary = stats.summary()
+    num_queries = sum(query['count'] for query in query_summary['queries'].values())
+
+    by_label = {}
+    for label, latency in timings:
+        by_label.setdefault(label, []).append(latency)
+
+    return {'workers': num_workers,
+            'seconds': elapsed,
+            'sessions': len(timings),
+            'sessions_per_second': len(timings) / elapsed,
+            'queries_per_second': num_queries / elapsed,
+            'session_latency': summarize_latencies([latency for _, latency in timings]),
+            'session_latency_by_mode': {label: summarize_latencies(latencies)
+                                        for label, latencies in sorted(by_label.items())},
+            'queries': query_summary['queries'],
+            'slow_queries': query_summary['slow_queries']}
+
+
+def format_ms(value):
+    return f'{value:8.1f}' if value is not None else '       -'
+
+
+def print_result(scale_factor, num_sales, index_present, result):
+    latency = result['session_latency']
+    print(f'Scale {scale_factor:g} ({num_sales} sales) || Pagination index: {"yes" if index_present else "no"} || '
+          f'Workers: {result["workers"]} || '
+          f'Sessions: {result["sessions"]} || {result["sessions_per_second"]:.1f} sessions/s || '
+          f'{result["queries_per_second"]:.1f} queries/s')
+    print(f'    {"all sessions":<14} p50 {format_ms(latency["p50_ms"])} ms  p95 {format_ms(latency["p95_ms"])} ms  '
+          f'p99 {format_ms(latency["p99_ms"])} ms')
+
+    for label, latency in result['session_latency_by_mode'].items():
+        print(f'    {label:<14} p50 {format_ms(latency["p50_ms"])} ms  p95 {format_ms(latency["p95_ms"])} ms  '
+              f'p99 {format_ms(latency["p99_ms"])} ms  ({latency["count"]} sessions)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Concurrent load test for the retailer query workload.')
+    parser.add_argument('--scale-factors', type=float, nargs='+', default=[0.1, 0.5, 1.0],
+                        help=f'Sales table sizes to test, as multiples of {BASE_NUM_SALES} sales')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8],
+                        help='Numbers of concurrent workers to test at each scale factor')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run each test for')
+    parser.add_argument('--record-share', type=float, default=0.6,
+                        help='Share of sessions listing sale records rather than summing them')
+    parser.add_argument('--range-share', type=float, default=0.5,
+                        help='Share of sessions limited to a date range')
+    parser.add_argument('--max-pages', type=int, default=3, help='Most pages of records a session will walk')
+    parser.add_argument('--seed', type=int, default=44, help='Seed for the simulated workload')
+    parser.add_argument('--create-index', action='store_true',
+                        help='Add the sales pagination index before testing, instead of measuring the current schema')
+    parser.add_argument('--output', default='load_test_results.json', help='File to save the full results to')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if max(args.workers) > MAX_POOL_SIZE:
+        raise ValueError(f'ERROR: at most {MAX_POOL_SIZE} concurrent workers are supported.')
+
+    tools, retailers, inventory = construct_workload_dataframes()
+    workload = {'r_ids': [int(r_id) for r_id in retailers['r_id'].unique()],
+                'tools': [(int(t_id), int(m_id)) for t_id, m_id in tools[['t_id', 'm_id']].itertuples(index=False)],
+                'record_share': args.record_share,
+                'range_share': args.range_share,
+                'max_pages': args.max_pages}
+
+    pool = sql_connection_pool(pool_size=max(args.workers), pool_name='toolsales_load_test')
+    if pool is None:
+        raise ConnectionError
+
+    results = []
+    for scale_factor in args.scale_factors:
+        num_sales = int(BASE_NUM_SALES * scale_factor)
+        print(f'Seeding the sales table with {num_sales} sales...')
+        workload['date_bounds'], index_present = seed_sales(inventory, retailers, num_sales, args.create_index)
+
+        for num_workers in args.workers:
+            result = run_load(pool, workload, num_workers, args.duration, args.seed)
+            print_result(scale_factor, num_sales, index_present, result)
+            results.append(dict(result, scale_factor=scale_factor, num_sales=num_sales, sales_index=index_present))
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+    print(f'Full results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
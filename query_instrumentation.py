@@ -0,0 +1,258 @@
+"""
+This module provides a thin instrumentation layer around the MySQL cursors used by the query scripts. Every statement
+run through an InstrumentedCursor is timed, and the latency, number of rows returned and approximate number of bytes
+fetched are recorded against a normalized 'template' of the query, so repeated lookups with different values are
+grouped together. Any statement slower than a configurable threshold also has its EXPLAIN plan captured, which makes
+it possible to see which queries regress (and why) as the sales table grows.
+
+The collected statistics can be exported as JSON or in the Prometheus text exposition format.
+"""
+
+import re
+import json
+import math
+import time
+import threading
+
+
+# Regular expressions used to collapse literal values out of a query so that it can be grouped by template
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+NUMERIC_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+WHITESPACE = re.compile(r'\s+')
+
+# Upper bounds (in seconds) of the latency histogram buckets kept for every query template, plus an overflow bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def normalize_query(query):
+    # Replace string and numeric literals with placeholders so f-string queries group with their siblings
+    template = STRING_LITERAL.sub('?', query)
+    template = NUMERIC_LITERAL.sub('?', template)
+    template = template.replace('%s', '?')  # Parameter markers are treated the same way as inlined literals
+    return WHITESPACE.sub(' ', template).strip()  # Collapse line breaks and repeated spaces
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a list of numbers, returns None for an empty list
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = min(max(1, math.ceil(pct / 100 * len(ordered))), len(ordered))  # Nearest rank, clamped to [1, n]
+    return ordered[rank - 1]
+
+
+def histogram_percentile(bounds, counts, pct, max_value):
+    # Estimate a nearest-rank percentile from histogram bucket counts by interpolating inside the bucket it falls in
+    # counts has one more entry than bounds - the last bucket holds everything above the largest bound
+    total = sum(counts)
+    if total == 0:
+        return None
+
+    rank = min(max(1, math.ceil(pct / 100 * total)), total)
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if cumulative + count >= rank:
+            lower = bounds[index - 1] if index > 0 else 0.0
+            upper = bounds[index] if index < len(bounds) else max_value
+            estimate = lower + (upper - lower) * (rank - cumulative) / count
+            return min(estimate, max_value)  # Never report more than the slowest query actually seen
+        cumulative += count
+
+
+def estimate_row_bytes(row):
+    # Approximate the number of bytes a row took on the wire using the text length of each value
+    total = 0
+    for value in row:
+        if value is None:
+            continue
+        elif isinstance(value, (bytes, bytearray)):
+            total += len(value)
+        else:
+            total += len(str(value).encode('utf-8'))
+    return total
+
+
+class QueryStats:
+    # Collects per-template latency histograms, row and byte counts, plus EXPLAIN output for slow queries
+    # Latencies are counted into fixed buckets, so memory use stays constant however many queries are recorded
+    def __init__(self, slow_query_threshold=0.5, max_slow_queries=100, buckets=LATENCY_BUCKETS):
+        self.slow_query_threshold = slow_query_threshold  # In seconds
+        self.buckets = tuple(sorted(buckets))
+        self.max_slow_queries = max_slow_queries  # Only the most recent slow queries are kept
+        self.templates = {}
+        self.slow_queries = []
+        self._lock = threading.Lock()  # Cursors on several threads may share a single collector
+
+    def record(self, query, elapsed, rows, num_bytes):
+        template = normalize_query(query)
+
+        with self._lock:
+            entry = self.templates.get(template)
+            if entry is None:
+                entry = {'bucket_counts': [0] * (len(self.buckets) + 1),  # The extra bucket is for overflow
+                         'count': 0, 'sum': 0.0, 'max': 0.0, 'rows': 0, 'bytes': 0, 'slow': 0}
+                self.templates[template] = entry
+
+            bucket = next((index for index, bound in enumerate(self.buckets) if elapsed <= bound), len(self.buckets))
+            entry['bucket_counts'][bucket] += 1
+            entry['count'] += 1
+            entry['sum'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['rows'] += rows
+            entry['bytes'] += num_bytes
+
+        return template
+
+    def is_slow(self, elapsed):
+        return self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold
+
+    def record_slow_query(self, template, query, params, elapsed, plan):
+        with self._lock:
+            self.templates[template]['slow'] += 1
+            self.slow_queries.append({'template': template,
+                                      'query': query,
+                                      'params': [str(param) for param in params] if params else [],
+                                      'elapsed': elapsed,
+                                      'plan': plan})
+            if len(self.slow_queries) > self.max_slow_queries:  # Drop the oldest entries once the log is full
+                del self.slow_queries[:len(self.slow_queries) - self.max_slow_queries]
+
+    def reset(self):
+        with self._lock:
+            self.templates = {}
+            self.slow_queries = []
+
+    def summary(self):
+        # Build a plain dictionary of statistics for every query template seen so far
+        with self._lock:
+            templates = {template: dict(entry, bucket_counts=list(entry['bucket_counts']))
+                         for template, entry in self.templates.items()}
+            slow_queries = list(self.slow_queries)
+
+        queries = {}
+        for template, entry in templates.items():
+            counts = entry['bucket_counts']
+
+            # Cumulative counts per bucket upper bound, in the same shape as a Prometheus histogram
+            histogram = {}
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                histogram[str(bound)] = cumulative
+
+            # Percentiles are estimated from the histogram buckets
+            queries[template] = {'count': entry['count'],
+                                 'total_seconds': entry['sum'],
+                                 'p50': histogram_percentile(self.buckets, counts, 50, entry['max']),
+                                 'p95': histogram_percentile(self.buckets, counts, 95, entry['max']),
+                                 'p99': histogram_percentile(self.buckets, counts, 99, entry['max']),
+                                 'max': entry['max'],
+                                 'histogram': histogram,
+                                 'rows': entry['rows'],
+                                 'bytes': entry['bytes'],
+                                 'slow': entry['slow']}
+
+        return {'slow_query_threshold': self.slow_query_threshold,
+                'queries': queries,
+                'slow_queries': slow_queries}
+
+    def to_json(self, indent=2):
+        return json.dumps(self.summary(), indent=indent, default=str)
+
+    def to_prometheus(self, prefix='toolsales_query'):
+        # Render the statistics in the Prometheus text exposition format
+        summary = self.summary()
+
+        def label(template):
+            escaped = template.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return f'query="{escaped}"'
+
+        lines = [f'# HELP {prefix}_latency_seconds Query latency by query template.',
+                 f'# TYPE {prefix}_latency_seconds histogram']
+        for template, stats in summary['queries'].items():
+            for bound, cumulative in stats['histogram'].items():
+                lines.append(f'{prefix}_latency_seconds_bucket{{{label(template)},le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_latency_seconds_sum{{{label(template)}}} {stats["total_seconds"]}')
+            lines.append(f'{prefix}_latency_seconds_count{{{label(template)}}} {stats["count"]}')
+
+        # The remaining metrics are simple per-template counters
+        counters = (('rows_total', 'rows', 'Rows returned by query template.'),
+                    ('bytes_total', 'bytes', 'Approximate bytes fetched by query template.'),
+                    ('slow_total', 'slow', 'Queries over the slow query threshold by query template.'))
+        for suffix, key, help_text in counters:
+            lines.append(f'# HELP {prefix}_{suffix} {help_text}')
+            lines.append(f'# TYPE {prefix}_{suffix} counter')
+            for template, stats in summary['queries'].items():
+                lines.append(f'{prefix}_{suffix}{{{label(template)}}} {stats[key]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filepath):
+        # Write the statistics to disk, choosing the format from the file extension
+        with open(filepath, 'w') as file:
+            if filepath.endswith('.prom') or filepath.endswith('.txt'):
+                file.write(self.to_prometheus())
+            else:
+                file.write(self.to_json())
+
+
+class InstrumentedCursor:
+    # Wraps a MySQL cursor, timing every statement and recording the results in a QueryStats collector
+    def __init__(self, connection, stats, **cursor_kwargs):
+        self.connection = connection
+        self.stats = stats
+        self.cursor = connection.cursor(**cursor_kwargs)  # e.g. prepared=True for a prepared-statement cursor
+        self._rows = []
+        self._position = 0
+
+    def execute(self, query, params=None):
+        start = time.perf_counter()
+        self.cursor.execute(query, params)
+
+        # Fetch the full result set here so that the timing covers the transfer of rows, not just the execution
+        rows = self.cursor.fetchall() if self.cursor.with_rows else []
+        elapsed = time.perf_counter() - start
+
+        self._rows = rows
+        self._position = 0
+
+        template = self.stats.record(query, elapsed, len(rows), sum(estimate_row_bytes(row) for row in rows))
+        if self.stats.is_slow(elapsed):
+            self.stats.record_slow_query(template, query, params, elapsed, self.explain(query, params))
+
+    def explain(self, query, params=None):
+        # Capture the execution plan for a query, using a separate cursor so the current result set is untouched
+        if not query.lstrip().upper().startswith('SELECT'):
+            return None
+
+        explain_cursor = self.connection.cursor(dictionary=True)
+        try:
+            explain_cursor.execute(f'EXPLAIN {query}', params)
+            return explain_cursor.fetchall()
+        except Exception as err_msg:  # The plan is diagnostic only, so never let it break the actual query
+            return [{'error': str(err_msg)}]
+        finally:
+            explain_cursor.close()
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def rowcount(self):
+        return len(self._rows)
+
+    def close(self):
+        self.cursor.close()
@@ -67,8 +67,6 @@ def construct_initial_dataframes():
     return manufacturers, tools, retailers
 
 
-manufacturers, tools, retailers = construct_initial_dataframes()  # Save returned values as global-scope dataframes
-
 """
 The next dataframe I'll create will represent the 'build' relation. Because of the structure of my database, the 'build'
 relation serves as the relational link between the 'manufacturers' and 'tools' relations, both of which were
@@ -77,15 +75,13 @@ where each tool id number (t_id) is matched with the appropriate manufacturer id
 relation (for convenience's sake) already contains this information, I can generate the dataframe for the 'build'
 relation by simply extracting those two columns from the 'tools' relation and saving them to a new dataframe object.
 """
-def construct_build_dataframe():
+def construct_build_dataframe(tools_dataframe):
     # Copy-and-paste the columns and values we need
-    build = tools[['m_id', 't_id']].copy()
+    build = tools_dataframe[['m_id', 't_id']].copy()
 
     return build  # Return the dataframe
 
 
-build = construct_build_dataframe()
-
 """
 Now, I need to begin properly simulating data at the scale required by the assignment. I need one dataframe containing
 tens of thousands of records and two dataframes containing thousands of records. 
@@ -153,8 +149,6 @@ def construct_orders_dataframe(tools_dataframe):
     return orders
 
 
-orders = construct_orders_dataframe(tools)
-
 # Debugging - ensuring that each t_id has a consistent price
 # If my code worked, each t_id will have a nunique() value of 1, i.e. each tool will have 1 consistent price value
 # unique_price_check = orders.groupby('t_id')['r_price'].nunique()  # Aggregate by t_id, and count unique r_price values
@@ -166,15 +160,13 @@ and order_id. Because both of these columns exist in the recently-populated orde
 dataframe for the 'comprise' relation by simply extracting those two columns from the 'tools' relation and saving them 
 to a new dataframe object.
 """
-def construct_comprise_dataframe():
+def construct_comprise_dataframe(orders_dataframe):
     # Copy-and-paste the columns and values I need from the orders dataframe
-    comprise = orders[['t_id', 'order_id']].copy()
+    comprise = orders_dataframe[['t_id', 'order_id']].copy()
 
     return comprise  # Return the dataframe
 
 
-comprise = construct_comprise_dataframe()
-
 # Debugging - ensuring that a small sample of order_id and t_id values match in both dataframes
 # print(orders.head())
 # print(comprise.head())
@@ -202,8 +194,6 @@ def construct_place_dataframe(orders_dataframe, retailers_dataframe):
     return place
 
 
-place = construct_place_dataframe(orders, retailers)
-
 # Debugging - making sure that r_id values are between 1 and 10 and that the r_id assignment in consistent when re-run
 # print(retailers)
 # print(orders.head(30))
@@ -245,8 +235,6 @@ def construct_stock_dataframe(retailers_dataframe, orders_dataframe):
     return stock
 
 
-stock = construct_stock_dataframe(retailers, tools)
-
 # Debugging - making sure tool ids, retailer ids, stock dates look okay
 # print(stock.head(50))
 # Everything seems fine
@@ -291,8 +279,6 @@ def construct_inventory_dataframe(stock_dataframe, orders_dataframe):
     return inventory
 
 
-inventory = construct_inventory_dataframe(stock, orders)
-
 # Debugging - checking for sensible values and matching records in the stock and inventory dataframes
 # print(stock.head(50))
 # print(inventory.head(50))
@@ -304,25 +290,29 @@ things I should need to reference other dataframes for are inventory to get t_id
 random r_id values. Sales data can be independent from current inventory data - these are essentially business records 
 of sales already made, which makes this easier. I'm going to have 50000 historical sale records.
 """
-def construct_sales_dataframe(inventory_dataframe, retailers_dataframe):
+def construct_sales_dataframe(inventory_dataframe, retailers_dataframe, num_sales=1000000, customer_ids=None):
     # Start by initializing a random number generator from the NumPy library
     randomgen = np.random.default_rng(44)  # Use a seed value so I get consistent values when I re-run the function
 
     # Create a unique list of sale_id values to serve as the primary key
-    sale_ids = list(range(1, 1000001))
+    # The number of sales can be changed, e.g. by the load tests, to simulate a smaller or larger sales table
+    sale_ids = list(range(1, num_sales + 1))
 
     # Generate values for r_id, t_id and c_id
-    r_ids = randomgen.choice(retailers_dataframe['r_id'], size=1000000)
-    t_ids = randomgen.choice(inventory_dataframe['t_id'], size=1000000)
-    c_ids = randomgen.integers(1000000, 9999999, size=1000000)  # I want all customer IDs to be seven-digit integers
+    r_ids = randomgen.choice(retailers_dataframe['r_id'], size=num_sales)
+    t_ids = randomgen.choice(inventory_dataframe['t_id'], size=num_sales)
+    if customer_ids is None:  # I want all customer IDs to be seven-digit integers
+        c_ids = randomgen.integers(1000000, 9999999, size=num_sales)
+    else:  # Re-use existing customers, e.g. when re-seeding sales without rebuilding the customers table
+        c_ids = randomgen.choice(customer_ids, size=num_sales)
 
     # Generate sale_date assuming the sales have occurred over the past five years
     start_date = pd.to_datetime('2018-07-10')
     total_days = (pd.to_datetime('2023-07-10') - start_date).days  # Calculates total number b/t start and end dates
-    sale_dates = start_date + pd.to_timedelta(randomgen.integers(0, total_days, size=1000000), unit='d')
+    sale_dates = start_date + pd.to_timedelta(randomgen.integers(0, total_days, size=num_sales), unit='d')
 
     # Generate quantity of tools sold in each sale as a random integer between 1 and 20
-    quantities = randomgen.integers(1, 21, size=1000000)
+    quantities = randomgen.integers(1, 21, size=num_sales)
 
     # Fetch c_price based on t_id
     price_dict = pd.Series(inventory_dataframe.c_price.values, index=inventory_dataframe.t_id).to_dict()
@@ -342,8 +332,6 @@ def construct_sales_dataframe(inventory_dataframe, retailers_dataframe):
     return sales
 
 
-sales = construct_sales_dataframe(inventory, retailers)
-
 # Debugging - making sure things look okay
 # print(sales.head(50))
 
@@ -378,8 +366,6 @@ def construct_customers_dataframe(sales_dataframe):
     return customers
 
 
-customers = construct_customers_dataframe(sales)
-
 """
 Now that I have all of my dataframes, I need a function that will pull each dataframe's data and convert the contents
 into a SQL-compatible INSERT INTO code-block. If the function I write is flexible enough, I should be able to call it
@@ -418,24 +404,56 @@ def generate_sql_inserts(dataframe, tablename, filepath):
                 file.write(line + ",\n")
 
 
-generate_sql_inserts(manufacturers, 'manufacturers', 'load_manufacturers_data.sql')  # Manufacturers table
+"""
+The sales table also needs an index for the client's paged record listings, which seek on (sale_date, sale_id) within a
+tool and retailer. I'll write that out as its own .sql script, to be run after the sales data has been loaded. The
+index name has to match SALES_PAGE_INDEX in db_query_scripts.py.
+"""
+def generate_index_sql(filepath):
+    with open(filepath, 'w') as file:
+        file.write("CREATE INDEX idx_sales_tool_retailer_date ON sales (t_id, r_id, sale_date, sale_id);\n")
+
+
+"""
+Finally, the whole pipeline lives in a main() function, so the script can still be run directly from the CLI to write
+the .sql files, while other scripts (like the load tests) can import the construction functions without kicking off the
+full data generation.
+"""
+def main():
+    manufacturers, tools, retailers = construct_initial_dataframes()
+    build = construct_build_dataframe(tools)
+    orders = construct_orders_dataframe(tools)
+    comprise = construct_comprise_dataframe(orders)
+    place = construct_place_dataframe(orders, retailers)
+    stock = construct_stock_dataframe(retailers, tools)
+    inventory = construct_inventory_dataframe(stock, orders)
+    sales = construct_sales_dataframe(inventory, retailers)
+    customers = construct_customers_dataframe(sales)
+
+    generate_sql_inserts(manufacturers, 'manufacturers', 'load_manufacturers_data.sql')  # Manufacturers table
+
+    generate_sql_inserts(build, 'build', 'load_build_data.sql')  # Build table
+
+    generate_sql_inserts(tools, 'tools', 'load_tools_data.sql')  # Tools table
+
+    generate_sql_inserts(comprise, 'comprise', 'load_comprise_data.sql')  # Comprise table
 
-generate_sql_inserts(build, 'build', 'load_build_data.sql')  # Build table
+    generate_sql_inserts(orders, 'orders', 'load_orders_data.sql')  # Orders table
 
-generate_sql_inserts(tools, 'tools', 'load_tools_data.sql')  # Tools table
+    generate_sql_inserts(place, 'place', 'load_place_data.sql')  # Place table
 
-generate_sql_inserts(comprise, 'comprise', 'load_comprise_data.sql')  # Comprise table
+    generate_sql_inserts(retailers, 'retailers', 'load_retailers_data.sql')  # Retailers table
 
-generate_sql_inserts(orders, 'orders', 'load_orders_data.sql')  # Orders table
+    generate_sql_inserts(stock, 'stock', 'load_stock_data.sql')  # Stock table
 
-generate_sql_inserts(place, 'place', 'load_place_data.sql')  # Place table
+    generate_sql_inserts(inventory, 'inventory', 'load_inventory_data.sql')  # Inventory table
 
-generate_sql_inserts(retailers, 'retailers', 'load_retailers_data.sql')  # Retailers table
+    generate_sql_inserts(sales, 'sales', 'load_sales_data.sql')  # Sales table
 
-generate_sql_inserts(stock, 'stock', 'load_stock_data.sql')  # Stock table
+    generate_index_sql('create_sales_index.sql')  # Pagination index on the sales table, run after loading sales
 
-generate_sql_inserts(inventory, 'inventory', 'load_inventory_data.sql')  # Inventory table
+    generate_sql_inserts(customers, 'customers', 'load_customers_data.sql')  # Customers table
 
-generate_sql_inserts(sales, 'sales', 'load_sales_data.sql')  # Sales table
 
-generate_sql_inserts(customers, 'customers', 'load_customers_data.sql')  # Customers table
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('mysql.connector')
+
+from db_query_scripts import decode_page_token, encode_page_token, fetch_sales_page
+
+
+class FakeSalesData:
+    # Stands in for ToolSalesData, serving sale records for a single tool and retailer from memory
+    def __init__(self, t_id, r_id, sales):
+        self.t_id = t_id
+        self.r_id = r_id
+        self.sales = sorted(sales, key=lambda sale: (sale[2], sale[0]))  # ORDER BY sale_date, sale_id
+
+    def is_connected(self):
+        return True
+
+    def sales_page(self, t_id, r_id, limit, start_date=None, end_date=None, after=None):
+        records = [sale for sale in self.sales if (t_id, r_id) == (self.t_id, self.r_id)]
+        if start_date is not None:
+            records = [sale for sale in records if str(start_date) <= str(sale[2]) <= str(end_date)]
+        if after is not None:
+            records = [sale for sale in records if (sale[2], sale[0]) > after]
+        return records[:limit]
+
+
+def make_sales(count):
+    # Several sales share each date, so the sale_id tiebreaker matters
+    first_date = datetime.date(2019, 1, 1)
+    return [(sale_id, 1000000 + sale_id, first_date + datetime.timedelta(days=sale_id % 7), 1, 9.99)
+            for sale_id in range(1, count + 1)]
+
+
+def walk(data, t_id, r_id, page_size, start_date=None, end_date=None):
+    pages = []
+    page_token = None
+    while True:
+        records, page_token = fetch_sales_page(data, t_id, r_id, start_date, end_date, page_token, page_size)
+        pages.append(records)
+        if page_token is None:
+            return pages
+
+
+def test_page_token_round_trip():
+    token = encode_page_token(3, 4, '2019-01-01', datetime.date(2019, 2, 1), datetime.date(2019, 1, 5), 17)
+    assert decode_page_token(token, 3, 4, datetime.date(2019, 1, 1), '2019-02-01') == (datetime.date(2019, 1, 5), 17)
+
+
+@pytest.mark.parametrize('token', ['', 'not a token', 'bm90IGpzb24=', 'e30=', 'WzEsIDJd'])
+def test_garbage_page_tokens_are_rejected(token):
+    with pytest.raises(ValueError, match='invalid page token'):
+        decode_page_token(token, 3, 4)
+
+
+@pytest.mark.parametrize('t_id, r_id, start_date, end_date', [
+    (9, 4, '2019-01-01', '2019-02-01'),  # Different tool
+    (3, 9, '2019-01-01', '2019-02-01'),  # Different retailer
+    (3, 4, '2019-01-02', '2019-02-01'),  # Different date range
+    (3, 4, None, None),  # No date range at all
+])
+def test_page_token_replayed_on_another_listing_is_rejected(t_id, r_id, start_date, end_date):
+    token = encode_page_token(3, 4, '2019-01-01', '2019-02-01', datetime.date(2019, 1, 5), 17)
+    with pytest.raises(ValueError, match='does not belong'):
+        decode_page_token(token, t_id, r_id, start_date, end_date)
+
+
+def test_exact_multiple_of_page_size_has_no_empty_last_page():
+    pages = walk(FakeSalesData(3, 4, make_sales(20)), 3, 4, page_size=5)
+    assert [len(page) for page in pages] == [5, 5, 5, 5]
+
+
+def test_walk_returns_every_row_once_in_order():
+    data = FakeSalesData(3, 4, make_sales(53))
+    rows = [record for page in walk(data, 3, 4, page_size=5) for record in page]
+    assert rows == data.sales
+
+
+def test_walk_with_date_range():
+    data = FakeSalesData(3, 4, make_sales(53))
+    rows = [record for page in walk(data, 3, 4, 4, '2019-01-02', '2019-01-04') for record in page]
+    assert rows == [sale for sale in data.sales if '2019-01-02' <= str(sale[2]) <= '2019-01-04']
+
+
+def test_empty_listing_is_a_single_empty_page():
+    assert walk(FakeSalesData(3, 4, []), 3, 4, page_size=5) == [[]]
+
+
+def test_invalid_page_requests_are_rejected():
+    data = FakeSalesData(3, 4, make_sales(5))
+    with pytest.raises(ValueError, match='page size'):
+        fetch_sales_page(data, 3, 4, page_size=0)
+    with pytest.raises(ValueError, match='both a start date and an end date'):
+        fetch_sales_page(data, 3, 4, start_date='2019-01-01')
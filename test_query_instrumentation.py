@@ -0,0 +1,140 @@
+from query_instrumentation import (InstrumentedCursor, QueryStats, histogram_percentile, normalize_query,
+                                   percentile)
+
+
+def test_percentile_nearest_rank():
+    assert percentile([5, 1, 4, 2, 3], 50) == 3
+    assert percentile(list(range(1, 22)), 50) == 11
+    assert percentile(list(range(1, 31)), 95) == 29
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_percentile_edges():
+    assert percentile([], 50) is None
+    assert percentile([7], 99) == 7
+    assert percentile([1, 2, 3], 0) == 1
+    assert percentile([1, 2, 3], 100) == 3
+
+
+def test_normalize_query_groups_literals():
+    assert normalize_query("SELECT t_name_full FROM tools WHERE t_id = 42") == \
+        "SELECT t_name_full FROM tools WHERE t_id = ?"
+    assert normalize_query("SELECT r_name FROM retailers WHERE r_id = %s") == \
+        "SELECT r_name FROM retailers WHERE r_id = ?"
+    assert normalize_query("SELECT * FROM sales\n  WHERE sale_date BETWEEN '2019-04-17' AND \"2019-04-23\"") == \
+        "SELECT * FROM sales WHERE sale_date BETWEEN ? AND ?"
+
+
+def test_normalize_query_keeps_identifiers():
+    # Digits inside column and table names are not literals
+    assert normalize_query("SELECT col1, t2.x FROM t2 WHERE a = -3.5") == "SELECT col1, t2.x FROM t2 WHERE a = ?"
+
+
+def test_histogram_percentile_interpolates_within_bucket():
+    bounds = (1.0, 2.0)
+    assert histogram_percentile(bounds, [0, 0, 0], 50, 0.0) is None
+    assert histogram_percentile(bounds, [2, 2, 0], 50, 2.0) == 1.0  # Rank 2 is the top of the first bucket
+    assert histogram_percentile(bounds, [2, 2, 0], 75, 2.0) == 1.5
+    assert histogram_percentile(bounds, [0, 0, 4], 99, 3.5) == 3.5  # Overflow bucket is capped at the max seen
+
+
+def test_query_stats_keeps_fixed_buckets():
+    stats = QueryStats(slow_query_threshold=None, buckets=(0.01, 0.1))
+    for elapsed in (0.005, 0.05, 0.05, 0.5):
+        stats.record("SELECT t_name_full FROM tools WHERE t_id = 3", elapsed, 1, 10)
+
+    query = stats.summary()['queries']["SELECT t_name_full FROM tools WHERE t_id = ?"]
+    assert query['count'] == 4
+    assert query['histogram'] == {'0.01': 1, '0.1': 3, '+Inf': 4}
+    assert query['max'] == 0.5
+    assert 'le="+Inf"} 4' in stats.to_prometheus()
+
+
+def test_slow_query_log_is_capped():
+    for max_slow_queries in (0, 2):
+        stats = QueryStats(slow_query_threshold=0, max_slow_queries=max_slow_queries)
+        for t_id in range(5):
+            template = stats.record(f"SELECT t_name_full FROM tools WHERE t_id = {t_id}", 1.0, 1, 10)
+            stats.record_slow_query(template, f"SELECT t_name_full FROM tools WHERE t_id = {t_id}", None, 1.0, [])
+
+        assert len(stats.slow_queries) == max_slow_queries
+        assert stats.summary()['queries']["SELECT t_name_full FROM tools WHERE t_id = ?"]['slow'] == 5
+
+    assert [entry['query'][-1] for entry in stats.slow_queries] == ['3', '4']  # The most recent entries are kept
+
+
+class FakeCursor:
+    # Stands in for a MySQL cursor, returning canned rows and logging every statement it is given
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.with_rows = False
+
+    def execute(self, query, params=None):
+        self.connection.executed.append((query, params))
+        if query.startswith('EXPLAIN') and self.connection.explain_error:
+            raise RuntimeError(self.connection.explain_error)
+
+        self.with_rows = query.startswith(('SELECT', 'EXPLAIN'))
+        self.rows = [{'table': 'sales'}] if query.startswith('EXPLAIN') else list(self.connection.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows, explain_error=None):
+        self.rows = rows
+        self.explain_error = explain_error
+        self.executed = []
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+
+def test_instrumented_cursor_records_rows_and_bytes():
+    connection = FakeConnection([(1, 'ab'), (2, None)])
+    stats = QueryStats(slow_query_threshold=None)
+    cursor = InstrumentedCursor(connection, stats)
+
+    cursor.execute("SELECT t_id, t_name_full FROM tools WHERE m_id = %s", (4,))
+    assert cursor.rowcount == 2
+    assert cursor.fetchone() == (1, 'ab')
+    assert list(cursor) == [(2, None)]
+    assert cursor.fetchone() is None
+
+    query = stats.summary()['queries']["SELECT t_id, t_name_full FROM tools WHERE m_id = ?"]
+    assert (query['count'], query['rows'], query['bytes']) == (1, 2, 4)  # '1' + 'ab' + '2', None counts as nothing
+    assert stats.slow_queries == []
+    assert not any(query.startswith('EXPLAIN') for query, _ in connection.executed)
+
+
+def test_instrumented_cursor_explains_only_slow_selects():
+    connection = FakeConnection([(1,)])
+    stats = QueryStats(slow_query_threshold=0)  # Every statement counts as slow
+    cursor = InstrumentedCursor(connection, stats)
+
+    cursor.execute("SELECT r_name FROM retailers WHERE r_id = %s", (3,))
+    cursor.execute("UPDATE retailers SET indep = 1")
+
+    assert ("EXPLAIN SELECT r_name FROM retailers WHERE r_id = %s", (3,)) in connection.executed
+    assert [entry['plan'] for entry in stats.slow_queries] == [[{'table': 'sales'}], None]
+    assert stats.slow_queries[0]['params'] == ['3']
+
+    stats = QueryStats(slow_query_threshold=60)  # Nothing is that slow
+    InstrumentedCursor(connection, stats).execute("SELECT r_name FROM retailers WHERE r_id = %s", (3,))
+    assert stats.slow_queries == []
+
+
+def test_instrumented_cursor_survives_explain_failure():
+    connection = FakeConnection([(1,)], explain_error='EXPLAIN denied')
+    stats = QueryStats(slow_query_threshold=0)
+    cursor = InstrumentedCursor(connection, stats)
+
+    cursor.execute("SELECT m_name FROM manufacturers WHERE m_id = %s", (2,))
+
+    assert cursor.fetchall() == [(1,)]  # The query itself still returns its rows
+    assert stats.slow_queries[0]['plan'] == [{'error': 'EXPLAIN denied'}]